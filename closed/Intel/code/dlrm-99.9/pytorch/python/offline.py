@@ -7,19 +7,27 @@ from __future__ import print_function
 from __future__ import unicode_literals
 
 import argparse
-import array
 import collections
 import json
 import logging
 import os
 import sys
 import multiprocessing
+from multiprocessing import shared_memory
+import queue
 import threading
 import time
 
 import mlperf_loadgen as lg
 import numpy as np
 
+try:
+    from numba import njit
+except ImportError:
+    # numba is optional, the helpers below then run as plain python
+    def njit(*args, **kwargs):
+        return lambda f: f
+
 # add dlrm code path
 try:
     dlrm_dir_path = os.environ['DLRM_DIR']
@@ -37,6 +45,12 @@ cpus_per_socket = int(os.getenv('CPUS_PER_SOCKET', 28))
 NANO_SEC = 1e9
 MILLI_SEC = 1000
 
+# result slots in each consumer's shared memory ring, rows are (result, target) float32 pairs
+RESULT_SLOTS = 4
+RESULT_ROW_BYTES = 2 * 4
+# max number of OItems answered by a single QuerySamplesComplete call
+RESPONSE_FLUSH_N = 64
+
 # pylint: disable=missing-docstring
 
 # the datasets we support
@@ -82,6 +96,7 @@ SCENARIO_MAP = {
 start_time = 0
 item_good = 0
 item_total = 0
+item_count = 0
 item_timing = []
 item_results = []
 last_timeing = []
@@ -158,6 +173,23 @@ def get_args():
     return args
 
 
+def get_result_slot_bytes(args):
+    # each query may aggregate several samples, every sample produces one row.
+    # mirror the query size selection of criteo.Criteo to find the longest possible query
+    if args.samples_to_aggregate_quantile_file is not None:
+        with open(sys.path[0] + "/" + args.samples_to_aggregate_quantile_file, 'r') as f:
+            line = f.readline()
+            quantile = np.fromstring(line, dtype=int, sep=", ")
+        rows_per_query = int(quantile.max())
+    elif args.samples_to_aggregate_min is not None and args.samples_to_aggregate_max is not None:
+        rows_per_query = args.samples_to_aggregate_max
+    elif args.samples_to_aggregate_fix is not None:
+        rows_per_query = args.samples_to_aggregate_fix
+    else:
+        rows_per_query = 1
+    return args.max_batchsize * rows_per_query * RESULT_ROW_BYTES
+
+
 def get_backend(backend, dataset, max_ind_range, data_sub_sample_rate, use_gpu, use_ipex):
 
     if backend == "pytorch-native":
@@ -209,21 +241,117 @@ class Item:
         self.content_id = content_id
         self.start = time.time()
 
+class ItemRing:
+    """A bounded JoinableQueue replacement passing Items through a shared memory ring."""
+
+    def __init__(self, maxsize, max_batchsize):
+        self.maxsize = maxsize
+        self.max_batchsize = max_batchsize
+        # per slot: (qid_len, idx_len) int64 header, start float64, then max_batchsize query ids and sample indexes
+        self.shm = shared_memory.SharedMemory(create=True, size=maxsize * (3 + 2 * max_batchsize) * 8)
+        self.free_slots = multiprocessing.Semaphore(maxsize)
+        self.used_slots = multiprocessing.Semaphore(0)
+        self.head = multiprocessing.Value("l", 0)
+        self.tail = multiprocessing.Value("l", 0)
+        self.unfinished = multiprocessing.Value("l", 0)
+        self.all_done = multiprocessing.Condition(self.unfinished.get_lock())
+        self._map()
+
+    def __getstate__(self):
+        # the views would be pickled as private copies, a spawned/forkserver child maps the segment by name
+        state = self.__dict__.copy()
+        for name in ("lens", "starts", "query_ids", "content_ids"):
+            del state[name]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._map()
+
+    def _map(self):
+        buf = self.shm.buf
+        offset = 0
+        self.lens = np.ndarray((self.maxsize, 2), np.int64, buf, offset)
+        offset += self.lens.nbytes
+        self.starts = np.ndarray(self.maxsize, np.float64, buf, offset)
+        offset += self.starts.nbytes
+        self.query_ids = np.ndarray((self.maxsize, self.max_batchsize), np.uint64, buf, offset)
+        offset += self.query_ids.nbytes
+        self.content_ids = np.ndarray((self.maxsize, self.max_batchsize), np.int64, buf, offset)
+
+    def put(self, item):
+        self.free_slots.acquire()
+        with self.unfinished.get_lock():
+            self.unfinished.value += 1
+        # hold the tail lock until the slot is published so consumers see slots in order
+        with self.tail.get_lock():
+            slot = self.tail.value % self.maxsize
+            if item is None:
+                self.lens[slot] = (-1, -1)
+            else:
+                qlen = len(item.query_id)
+                ilen = len(item.content_id)
+                self.lens[slot] = (qlen, ilen)
+                self.starts[slot] = item.start
+                self.query_ids[slot, :qlen] = item.query_id
+                self.content_ids[slot, :ilen] = item.content_id
+            self.tail.value += 1
+            self.used_slots.release()
+
+    def get(self):
+        self.used_slots.acquire()
+        with self.head.get_lock():
+            slot = self.head.value % self.maxsize
+            qlen, ilen = self.lens[slot].tolist()
+            if qlen < 0:
+                item = None
+            else:
+                item = Item(self.query_ids[slot, :qlen].tolist(), self.content_ids[slot, :ilen].tolist())
+                item.start = float(self.starts[slot])
+            self.head.value += 1
+        self.free_slots.release()
+        return item
+
+    def task_done(self):
+        with self.all_done:
+            self.unfinished.value -= 1
+            if self.unfinished.value == 0:
+                self.all_done.notify_all()
+
+    def join(self):
+        with self.all_done:
+            while self.unfinished.value > 0:
+                self.all_done.wait()
+
+    def close(self):
+        self.lens = self.starts = self.query_ids = self.content_ids = None
+        self.shm.close()
+        self.shm.unlink()
+
 class OItem:
-    def __init__(self, presults, query_ids=None, array_ref=None, good=0, total=0, timing=0):
+    def __init__(self, presults, query_ids=None, idx_offsets=None, row_bytes=0, good=0, total=0, timing=0, shm_slot=None):
         self.good = good
         self.total = total
         self.timing = timing
         self.presults = presults
         self.query_ids = query_ids
-        self.array_ref = array_ref
+        self.idx_offsets = idx_offsets
+        self.row_bytes = row_bytes
+        # (proc_num, slot, shape) when presults were written to the consumer's shared memory ring
+        self.shm_slot = shm_slot
 
 class Consumer(multiprocessing.Process):
 
-    def __init__(self, task_queue, result_queue, ds_queue, lock, init_counter, total_samples, proc_num, args):
+    def __init__(self, task_queue, result_queue, ds_queue, init_cond, init_counter, total_samples, proc_num, args,
+                 result_shm, free_slots):
         multiprocessing.Process.__init__(self)
         self.args = args
-        self.lock = lock
+        self.result_shm = result_shm
+        self.free_slots = free_slots
+        self.slot_bytes = get_result_slot_bytes(args)
+        self.next_slot = 0
+        self.slot_overflow_logged = False
+        self.init_cond = init_cond
         self.proc_num = proc_num
         self.ds_queue = ds_queue
         self.task_queue = task_queue
@@ -277,14 +405,31 @@ class Consumer(multiprocessing.Process):
             model.predict(batch_dense_X, batch_lS_o, batch_lS_i)
         ds.unload_query_samples(None)
 
-        self.lock.acquire()
-        self.init_counter.value += 1
-        self.total_samples.value = ds.get_item_count()
-        self.lock.release() 
+        with self.init_cond:
+            self.init_counter.value += 1
+            self.total_samples.value = ds.get_item_count()
+            self.init_cond.notify_all()
 
 
+    def prefetch(self, ds, prefetch_queue):
+        # gather the next batch while the current one is in model.predict
+        while True:
+            qitem = self.task_queue.get()
+            if qitem is None:
+                prefetch_queue.put((None, None))
+                break
+            try:
+                samples = ds.get_samples(qitem.content_id)
+            except Exception as ex:  # pylint: disable=broad-except
+                # hand the failure to run(), a dead prefetcher would leave it blocked forever
+                samples = ex
+            prefetch_queue.put((qitem, samples))
+
     def run(self):
         os.sched_setaffinity(self.pid, self.affinity)
+        # size the OpenMP/MKL pools to this consumer's cores before torch is loaded
+        os.environ["OMP_NUM_THREADS"] = str(len(self.affinity))
+        os.environ["MKL_NUM_THREADS"] = str(len(self.affinity))
         import torch
         global num_sockets
         global cpus_per_socket
@@ -301,54 +446,80 @@ class Consumer(multiprocessing.Process):
         # Load data
         sample_list = self.ds_queue.get()
         ds.load_query_samples(sample_list)
-        self.lock.acquire()
-        self.init_counter.value += 1
-        self.lock.release() 
+        with self.init_cond:
+            self.init_counter.value += 1
+            self.init_cond.notify_all()
+
+        prefetch_queue = queue.Queue(1)
+        prefetcher = threading.Thread(target=self.prefetch, args=(ds, prefetch_queue))
+        prefetcher.daemon = True
+        prefetcher.start()
 
         while True:
-            qitem = self.task_queue.get()
+            qitem, samples = prefetch_queue.get()
             if qitem is None:
                 ds.unload_query_samples(sample_list)
                 self.task_queue.task_done()
                 print('Exiting', self.name, 'pid', self. pid)
                 break
+            if isinstance(samples, Exception):
+                log.error("thread: failed, %s", samples)
+                # answer every query with an empty response, as a failed predict does
+                self.result_queue.put(OItem(np.empty((0, 2), np.float32), qitem.query_id,
+                                            np.zeros(len(qitem.query_id) + 1, np.int64), 0))
+                self.task_queue.task_done()
+                continue
 
-            batch_dense_X, batch_lS_o, batch_lS_i, batch_T, idx_offsets = ds.get_samples(qitem.content_id)
+            batch_dense_X, batch_lS_o, batch_lS_i, batch_T, idx_offsets = samples
 
             good = 0
             total = 0
-            presults = []
+            pres_np = np.empty((0, 2), np.float32)
+            slot = None
             result_timing = 0
             try:
-                results = model.predict(batch_dense_X, batch_lS_o, batch_lS_i)
+                results = model.predict(batch_dense_X, batch_lS_o, batch_lS_i).detach()
                 # post_process
-                results = results.detach().cpu()
                 total = len(results)
-                good = (results.round() == batch_T).nonzero().size(0)
-                presults = torch.cat((results, batch_T), dim=1)
-
+                # count on the model device, only the count comes back to the host
+                good = int((results.round() == batch_T.to(results.device)).sum().item())
+                # the float32 rows are needed in every mode, loadgen may sample them into the
+                # accuracy log during performance runs (e.g. TEST01 via audit.config)
+                results = results.cpu()
+                if total * RESULT_ROW_BYTES <= self.slot_bytes:
+                    # concatenate straight into the next free ring slot, the slots are reused across batches
+                    self.free_slots.acquire()
+                    slot = self.next_slot
+                    self.next_slot = (self.next_slot + 1) % RESULT_SLOTS
+                    pres_np = np.ndarray((total, 2), np.float32, self.result_shm.buf, slot * self.slot_bytes)
+                    torch.cat((results.float(), batch_T.float()), dim=1, out=torch.from_numpy(pres_np))
+                else:
+                    if not self.slot_overflow_logged:
+                        log.warning("batch of %d rows exceeds the %d byte result slot, sending it through the queue",
+                                    total, self.slot_bytes)
+                        self.slot_overflow_logged = True
+                    presults = torch.cat((results, batch_T), dim=1).to(torch.float32).contiguous()
+                    # float32 view sharing memory with presults, sliced per query below without copies
+                    pres_np = presults.numpy()
                 if self.args.accuracy:
                     result_timing = time.time() - qitem.start
             except Exception as ex:  # pylint: disable=broad-except
                 log.error("thread: failed, %s", ex)
-                presults = [[]] * len(qitem.query_id)
+                pres_np = pres_np[:0]
             finally:
-                response_array_refs = []
-                for idx, query_id in enumerate(qitem.query_id):
-                    # NOTE: processed_results returned by DlrmPostProcess store both
-                    # result = processed_results[idx][0] and target = processed_results[idx][1]
-                    # also each idx might be a query of samples, rather than a single sample
-                    # depending on the --samples-to-aggregate* arguments.
-                    s_idx = idx_offsets[idx]
-                    e_idx = idx_offsets[idx + 1]
-                    # debug prints
-                    # print("s,e:",s_idx,e_idx, len(processed_results))
-                    response_array = array.array("B", np.array(presults[s_idx:e_idx], np.float32).tobytes())
-                    response_array_refs.append(response_array)
-                if self.args.accuracy:
-                    self.result_queue.put(OItem(np.array(presults, np.float32), qitem.query_id, response_array_refs, good, total, result_timing))
+                # all responses of the batch live in pres_np, query idx owns rows idx_offsets[idx]:idx_offsets[idx + 1]
+                # NOTE: processed_results returned by DlrmPostProcess store both
+                # result = processed_results[idx][0] and target = processed_results[idx][1]
+                # also each idx might be a query of samples, rather than a single sample
+                # depending on the --samples-to-aggregate* arguments.
+                row_bytes = pres_np.shape[1] * pres_np.itemsize if len(pres_np) else 0
+                response_offsets = np.asarray(idx_offsets, np.int64)
+                if slot is not None:
+                    # only the slot handle goes through the queue
+                    self.result_queue.put(OItem(None, qitem.query_id, response_offsets, row_bytes, good, total, result_timing,
+                                                (self.proc_num, slot, pres_np.shape)))
                 else:
-                    self.result_queue.put(OItem([], qitem.query_id, response_array_refs, good, total, result_timing))
+                    self.result_queue.put(OItem(pres_np, qitem.query_id, response_offsets, row_bytes, good, total, result_timing))
             self.task_queue.task_done()
 
 class QueueRunner:
@@ -358,6 +529,9 @@ class QueueRunner:
 
     def enqueue(self, query_id, idx):
         query_len = len(query_id)
+        # convert once, the chunks below are views copied straight into the ring slots
+        query_id = np.asarray(query_id, np.uint64)
+        idx = np.asarray(idx, np.int64)
 
         if query_len < self.max_batchsize:
             self.inQueue.put(Item(query_id, idx))
@@ -370,7 +544,13 @@ class QueueRunner:
 
 def add_results(final_results, name, result_dict, result_list, took, show_accuracy=False):
     percentiles = [50., 80., 90., 95., 99., 99.9]
-    buckets = np.percentile(result_list, percentiles).tolist()
+    # sort once and interpolate every percentile between its neighbouring ranks,
+    # same values as np.percentile without a selection pass per percentile
+    srt = np.sort(np.asarray(result_list))
+    k = np.asarray(percentiles) / 100.0 * (len(srt) - 1)
+    lo = np.floor(k).astype(np.int64)
+    hi = np.minimum(lo + 1, len(srt) - 1)
+    buckets = (srt[lo] + (srt[hi] - srt[lo]) * (k - lo)).tolist()
     buckets_str = ",".join(["{}:{:.4f}".format(p, b) for p, b in zip(percentiles, buckets)])
 
     if result_dict["total"] == 0:
@@ -402,29 +582,93 @@ def add_results(final_results, name, result_dict, result_list, took, show_accura
         name, result["qps"], result["mean"], took, acc_str,
         len(result_list), buckets_str))
 
-def response_loadgen(outQueue, accuracy):
+@njit(cache=True)
+def pack_responses(idx_offsets, offset_ends, base_ptrs, row_bytes):
+    # idx_offsets chains the n + 1 row offsets of every OItem, offset_ends[i] is where OItem i's run ends
+    n = len(idx_offsets) - len(offset_ends)
+    ptrs = np.empty(n, np.int64)
+    sizes = np.empty(n, np.int64)
+    q = 0
+    s = 0
+    for i in range(len(offset_ends)):
+        for j in range(s, offset_ends[i] - 1):
+            ptrs[q] = base_ptrs[i] + idx_offsets[j] * row_bytes[i]
+            sizes[q] = (idx_offsets[j + 1] - idx_offsets[j]) * row_bytes[i]
+            q += 1
+        s = offset_ends[i]
+    return ptrs, sizes
+
+
+def response_loadgen(outQueue, accuracy, expected_items, result_shms, free_slots, slot_bytes):
     global item_good
     global item_total
+    global item_count
     global item_timing
     global item_results
 
-    while True:
-        oitem = outQueue.get()
-        if oitem is None:
-            break
-
-        response = []
-        for q_id, arr in zip(oitem.query_ids, oitem.array_ref):
-            bi = arr.buffer_info()
-            response.append(lg.QuerySampleResponse(q_id, bi[0], bi[1]))
-        lg.QuerySamplesComplete(response)
-
-        item_good += oitem.good
-        item_total += oitem.total
+    if accuracy:
+        # every accuracy sample is its own query, so expected_items bounds the number of OItems
+        item_timing = np.empty(expected_items, np.float64)
+        item_results = [None] * expected_items
 
-        if accuracy:
-            item_timing.append(oitem.timing)
-            item_results.append(oitem.presults)
+    done = False
+    while not done:
+        # coalesce whatever is already queued into one QuerySamplesComplete call
+        pending = [outQueue.get()]
+        while pending[-1] is not None and len(pending) < RESPONSE_FLUSH_N:
+            try:
+                pending.append(outQueue.get_nowait())
+            except queue.Empty:
+                break
+        if pending[-1] is None:
+            done = True
+            pending.pop()
+
+        query_ids = []
+        idx_offsets = []
+        base_ptrs = []
+        row_bytes = []
+        # buffers the responses point into must stay alive until loadgen has seen them
+        buffers = []
+        used_slots = []
+        for oitem in pending:
+            if oitem.shm_slot is not None:
+                proc_num, slot, shape = oitem.shm_slot
+                presults = np.ndarray(shape, np.float32, result_shms[proc_num].buf, slot * slot_bytes)
+                used_slots.append(proc_num)
+            else:
+                presults = oitem.presults
+            buffers.append(presults)
+
+            base, _ = presults.__array_interface__["data"]
+            query_ids.extend(oitem.query_ids)
+            idx_offsets.append(oitem.idx_offsets)
+            base_ptrs.append(base)
+            row_bytes.append(oitem.row_bytes)
+
+            item_good += oitem.good
+            item_total += oitem.total
+
+            if accuracy:
+                if item_count == len(item_timing):
+                    item_timing = np.concatenate((item_timing, np.empty(max(item_count, 1), np.float64)))
+                    item_results.extend([None] * max(item_count, 1))
+                item_timing[item_count] = oitem.timing
+                # copy out of the ring, the slot is handed back to the consumer below
+                item_results[item_count] = np.array(presults) if oitem.shm_slot is not None else presults
+                item_count += 1
+
+        if query_ids:
+            offset_ends = np.cumsum([len(offsets) for offsets in idx_offsets])
+            ptrs, sizes = pack_responses(np.concatenate(idx_offsets), offset_ends,
+                                         np.array(base_ptrs, np.int64), np.array(row_bytes, np.int64))
+            # map drives the pybind constructor from C, no bytecode runs per response
+            response = list(map(lg.QuerySampleResponse, query_ids, ptrs.tolist(), sizes.tolist()))
+            lg.QuerySamplesComplete(response)
+
+        presults = buffers = None
+        for proc_num in used_slots:
+            free_slots[proc_num].release()
 
 
 def main():
@@ -435,6 +679,8 @@ def main():
 
     args = get_args()
     log.info(args)
+    # keep the main process and the response thread on the cores left free by consumer 0
+    os.sched_setaffinity(0, {0, 1})
     config = os.path.abspath(args.config)
     user_config = os.path.abspath(args.user_config)
 
@@ -451,24 +697,32 @@ def main():
         os.makedirs(output_dir, exist_ok=True)
         os.chdir(output_dir)
 
-    lock = multiprocessing.Lock()
+    init_cond = multiprocessing.Condition(multiprocessing.Lock())
     init_counter = multiprocessing.Value("i", 0)
     total_samples = multiprocessing.Value("i", 0)
     dsQueue = multiprocessing.Queue()
     outQueue = multiprocessing.Queue()
-    inQueue = multiprocessing.JoinableQueue(num_sockets * 4)
-    consumers = [Consumer(inQueue, outQueue, dsQueue, lock, init_counter, total_samples, i, args)
+    inQueue = ItemRing(num_sockets * 4, args.max_batchsize)
+    slot_bytes = get_result_slot_bytes(args)
+    result_shms = [shared_memory.SharedMemory(create=True, size=RESULT_SLOTS * slot_bytes)
+                   for _ in range(num_sockets)]
+    free_slots = [multiprocessing.Semaphore(RESULT_SLOTS) for _ in range(num_sockets)]
+    consumers = [Consumer(inQueue, outQueue, dsQueue, init_cond, init_counter, total_samples, i, args,
+                          result_shms[i], free_slots[i])
                  for i in range(num_sockets)]
     for c in consumers:
         c.start()
 
     # Wait until subprocess ready
-    while init_counter.value < num_sockets: time.sleep(2)
+    with init_cond:
+        init_cond.wait_for(lambda: init_counter.value >= num_sockets)
   
     # Start response thread
     response_worker = threading.Thread(
-        target=response_loadgen, args=(outQueue, args.accuracy))
+        target=response_loadgen, args=(outQueue, args.accuracy, total_samples.value, result_shms, free_slots, slot_bytes))
     response_worker.daemon = True
+    # compile pack_responses now, a cold njit call inside the test costs a few hundred ms
+    pack_responses(np.zeros(2, np.int64), np.array([2], np.int64), np.zeros(1, np.int64), np.zeros(1, np.int64))
     response_worker.start()
 
     scenario = SCENARIO_MAP[args.scenario]
@@ -488,7 +742,7 @@ def main():
     def process_latencies(latencies_ns):
         # called by loadgen to show us the recorded latencies
         global last_timeing
-        last_timeing = [t / NANO_SEC for t in latencies_ns]
+        last_timeing = np.asarray(latencies_ns, dtype=np.float64) * (1.0 / NANO_SEC)
 
     settings = lg.TestSettings()
     settings.FromConfig(config, args.model, args.scenario)
@@ -527,7 +781,8 @@ def main():
         global start_time
         for _ in range(num_sockets):
             dsQueue.put(sample_list)
-        while init_counter.value < 2 * num_sockets: time.sleep(2)
+        with init_cond:
+            init_cond.wait_for(lambda: init_counter.value >= 2 * num_sockets)
         start_time = time.time()
 
     def unload_query_samples(sample_list):
@@ -544,12 +799,12 @@ def main():
 
     lg.StartTest(sut, qsl, settings)
 
-    if not last_timeing:
-        last_timeing = item_timing
+    if len(last_timeing) == 0:
+        last_timeing = item_timing[:item_count]
     if args.accuracy:
         result_dict["good"] = item_good
         result_dict["total"] = item_total
-        result_dict["roc_auc"] = criteo.auc_score(item_results)
+        result_dict["roc_auc"] = criteo.auc_score(item_results[:item_count])
 
     final_results = {
         "runtime": "pytorch-native-dlrm",
@@ -567,6 +822,11 @@ def main():
     for c in consumers:
         c.join()
     outQueue.put(None)
+    response_worker.join()
+    inQueue.close()
+    for shm in result_shms:
+        shm.close()
+        shm.unlink()
 
     lg.DestroyQSL(qsl)
     lg.DestroyFastSUT(sut)